@@ -18,19 +18,24 @@
 
 from __future__ import annotations
 
+import functools
 import io
 import math
 from datetime import datetime
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import streamlit as st
 import numpy as np
 import matplotlib.pyplot as plt
+from PIL import Image
 
-from qiskit import QuantumCircuit, transpile
-from qiskit.visualization import plot_histogram, plot_bloch_multivector
-from qiskit.quantum_info import Statevector, Pauli
-from qiskit_aer import AerSimulator
+from qiskit import QuantumCircuit, qasm2
+from qiskit.quantum_info import Statevector
+
+# qiskit_aer y qiskit.visualization son pesados: se importan sólo donde se usan
+if TYPE_CHECKING:
+    from qiskit_aer import AerSimulator
 
 # =================== Configuración de página ===================
 st.set_page_config(
@@ -44,13 +49,32 @@ BANNER = "Script desarrollado por Marcos Sebastian Cunioli - Especialista en Cib
 st.success(BANNER)
 
 # =================== Parámetros y utilidades ===================
+# Todas las figuras se cierran explícitamente (fig_to_png y plt.close("all") en cada paso)
+plt.rcParams["figure.max_open_warning"] = 0
+
 if "STAMP" not in st.session_state:
     st.session_state.STAMP = datetime.now().strftime("%Y%m%d-%H%M%S")
 STAMP = st.session_state.STAMP
 
 OUTPUT_DIR = Path(st.sidebar.text_input("Carpeta para guardar PNGs", value="figuras"))
 SAVE_PNGS = st.sidebar.checkbox("Guardar figuras como PNG", value=True)
+HIFI_PNGS = st.sidebar.checkbox(
+    "PNG de alta fidelidad (sin paleta)",
+    value=False,
+    help="Si está desactivado, los PNG se guardan con una paleta de 64 colores (mucho más livianos).",
+)
 DEFAULT_SHOTS = st.sidebar.slider("Shots (repeticiones por corrida)", 100, 50000, 1000, step=100)
+USE_AER = st.sidebar.checkbox(
+    "Usar AerSimulator (simulador \"real\")",
+    value=False,
+    help="Si está desactivado, las cuentas se muestrean de la distribución exacta del Statevector.",
+)
+SEED = int(st.sidebar.number_input("Semilla (0 = aleatoria)", min_value=0, value=0, step=1))
+
+# Un único generador por sesión: se recrea sólo si cambia la semilla
+if st.session_state.get("rng_seed") != SEED:
+    st.session_state.rng = np.random.default_rng(SEED or None)
+    st.session_state.rng_seed = SEED
 
 st.sidebar.caption(
     f"Las imágenes se guardarán con timestamp {STAMP} en: {OUTPUT_DIR.resolve()}"
@@ -58,9 +82,45 @@ st.sidebar.caption(
 
 @st.cache_resource(show_spinner=False)
 def get_simulator() -> AerSimulator:
+    from qiskit_aer import AerSimulator
+
     return AerSimulator()
 
 
+def paso1_circuit() -> QuantumCircuit:
+    """Moneda cuántica: H + medida."""
+    qc = QuantumCircuit(1)
+    qc.h(0)
+    qc.measure_all()
+    return qc
+
+
+def paso3_circuit() -> QuantumCircuit:
+    """Dos Hadamard seguidas + medida."""
+    qc = QuantumCircuit(1)
+    qc.h(0)
+    qc.h(0)
+    qc.measure_all()
+    return qc
+
+
+def paso4_circuit() -> QuantumCircuit:
+    """H – P(π) – H + medida."""
+    qc = QuantumCircuit(1)
+    qc.h(0)
+    qc.p(math.pi, 0)
+    qc.h(0)
+    qc.measure_all()
+    return qc
+
+
+def run_aer(qc: QuantumCircuit, shots: int):
+    """Ejecuta en AerSimulator sin transpilar: h, p, rz y sx ya son nativas del método statevector."""
+    # La semilla sale del generador de la sesión: con semilla fija, Aer también es reproducible
+    seed = int(st.session_state.rng.integers(2**31))
+    return get_simulator().run(qc, shots=shots, method="statevector", seed_simulator=seed).result()
+
+
 def ensure_outdir(directory: Path) -> None:
     try:
         directory.mkdir(parents=True, exist_ok=True)
@@ -68,49 +128,141 @@ def ensure_outdir(directory: Path) -> None:
         st.warning(f"No se pudo crear la carpeta '{directory}': {e}")
 
 
-def save_fig(fig, base_name: str) -> None:
-    """Guardar figura PNG en OUTPUT_DIR con timestamp."""
+def fig_to_png(fig) -> bytes:
+    """Renderizar la figura a PNG en memoria y cerrarla."""
+    buf = io.BytesIO()
+    try:
+        fig.savefig(buf, format="png", bbox_inches="tight", dpi=200)
+    finally:
+        plt.close(fig)
+    return buf.getvalue()
+
+
+def _fast_hist(counts: dict[str, int], title: str):
+    """Histograma de barras simple con Matplotlib (sin plot_histogram)."""
+    fig, ax = plt.subplots(figsize=(4, 3))
+    keys = sorted(counts)
+    ax.bar(keys, [counts[k] for k in keys])
+    ax.set_title(title)
+    ax.set_ylabel("counts")
+    return fig
+
+
+# Cachés acotadas: las counts muestreadas casi nunca se repiten y la caché es de todo el proceso
+PNG_CACHE_ENTRIES = 32
+
+
+@st.cache_data(show_spinner=False, max_entries=PNG_CACHE_ENTRIES)
+def _hist_png(counts_items: tuple[tuple[str, int], ...], title: str) -> bytes:
+    """PNG del histograma, cacheado por (counts, título)."""
+    return fig_to_png(_fast_hist(dict(counts_items), title))
+
+
+@st.cache_data(show_spinner=False, max_entries=PNG_CACHE_ENTRIES)
+def _bloch_png(amplitudes: tuple[complex, ...], title: str = "") -> bytes:
+    """PNG de las esferas de Bloch (una por qubit), cacheado por las amplitudes del estado."""
+    from qiskit.visualization import plot_bloch_multivector
+
+    return fig_to_png(plot_bloch_multivector(Statevector(np.array(amplitudes)), title=title))
+
+
+def quantize_png(png: bytes, colors: int = 64) -> bytes:
+    """Convertir un PNG truecolor a PNG con paleta de 8 bits."""
+    img = Image.open(io.BytesIO(png)).convert("RGB")
+    # MEDIANCUT no admite RGBA; las figuras tienen fondo blanco opaco
+    img = img.quantize(colors=colors, method=Image.Quantize.MEDIANCUT)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
+
+
+def save_png(png: bytes, base_name: str) -> None:
+    """Guardar PNG en OUTPUT_DIR con timestamp."""
     ensure_outdir(OUTPUT_DIR)
     fname = OUTPUT_DIR / f"{STAMP}_{base_name}.png"
     try:
-        fig.savefig(fname, bbox_inches="tight", dpi=200)
+        fname.write_bytes(png if HIFI_PNGS else quantize_png(png))
         st.info(f"🖼️ Guardado: {fname}")
     except Exception as e:
         st.warning(f"No se pudo guardar {fname}: {e}")
-    finally:
-        plt.close(fig)
 
 
-def draw_circuit_text(qc: QuantumCircuit) -> str:
-    """Render del circuito en formato texto para mostrar en código."""
+def show_png(png: bytes, base_name: str | None = None) -> None:
+    """Mostrar el PNG en la app y guardarlo si SAVE_PNGS está activo."""
+    st.image(png, width="stretch")
+    if SAVE_PNGS and base_name:
+        save_png(png, base_name)
+
+
+@st.cache_data(show_spinner=False)
+def draw_circuit_text(qasm: str) -> str:
+    """Render del circuito (dado en QASM) en formato texto para mostrar en código."""
     try:
-        return qc.draw(output="text").__str__()
+        return str(QuantumCircuit.from_qasm_str(qasm).draw(output="text"))
     except Exception:
         return "(No fue posible dibujar el circuito en texto)"
 
 
+@st.cache_data(show_spinner=False)
+def _sv_probs_and_exps(qasm: str) -> tuple[np.ndarray, float, float]:
+    """Amplitudes del Statevector y expectativas ⟨Z⟩, ⟨X⟩ de un circuito de 1 qubit."""
+    qc = QuantumCircuit.from_qasm_str(qasm)
+    psi = Statevector.from_instruction(qc)
+    # Para |ψ⟩ = a|0⟩ + b|1⟩: ⟨Z⟩ = |a|² − |b|² y ⟨X⟩ = 2·Re(a*·b)
+    a, b = psi.data
+    expZ = float(abs(a) ** 2 - abs(b) ** 2)
+    expX = float(2 * (a.conjugate() * b).real)
+    return psi.data, expZ, expX
+
+
+MAX_ANALYTIC_QUBITS = 6
+
+
+def can_sample_analytically(qc: QuantumCircuit) -> bool:
+    """¿Se puede muestrear del Statevector? (pocos qubits y sin medidas intermedias)."""
+    return qc.num_qubits <= MAX_ANALYTIC_QUBITS and all(
+        inst.operation.name != "measure" for inst in qc.data
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _labels(n: int) -> tuple[str, ...]:
+    """Etiquetas de bits ('0', '1', '00', ...) para n qubits, calculadas una sola vez."""
+    return tuple(format(i, f"0{n}b") for i in range(1 << n))
+
+
+def analytic_counts(qc: QuantumCircuit, shots: int) -> dict[str, int]:
+    """Muestrear counts de la distribución exacta del Statevector (sin medidas)."""
+    probs = Statevector.from_instruction(qc).probabilities()
+    k = st.session_state.rng.multinomial(shots, probs)
+    labels = _labels(qc.num_qubits)
+    return {labels[i]: int(k[i]) for i in range(len(probs)) if k[i]}
+
+
 def run_and_plot_counts(qc: QuantumCircuit, shots: int, title: str, base_name: str | None = None):
-    """Compila, ejecuta en AerSimulator y muestra/guarda histograma de counts."""
-    sim = get_simulator()
-    qct = transpile(qc, sim)
-    result = sim.run(qct, shots=shots).result()
-    counts = result.get_counts()
+    """Obtiene counts (analíticos o con AerSimulator) y muestra/guarda el histograma.
 
-    st.code(draw_circuit_text(qc), language="text")
+    Sin el modo Aer, los circuitos chicos y sin medidas intermedias se muestrean del Statevector;
+    el resto cae a AerSimulator.
+    """
+    unmeasured = qc.remove_final_measurements(inplace=False)
+    if not USE_AER and can_sample_analytically(unmeasured):
+        counts = analytic_counts(unmeasured, shots)
+    else:
+        counts = run_aer(qc, shots).get_counts()
+
+    st.code(draw_circuit_text(qasm2.dumps(qc)), language="text")
+    plot_counts(counts, title=title, base_name=base_name)
+    return counts
 
-    # Histograma
+
+def plot_counts(counts: dict[str, int], title: str, base_name: str | None = None) -> None:
+    """Muestra/guarda el histograma de counts."""
     try:
-        fig = plot_histogram(counts, title=title)
-        st.pyplot(fig)
-        if SAVE_PNGS and base_name:
-            save_fig(fig, base_name)
-        else:
-            plt.close(fig)
+        show_png(_hist_png(tuple(sorted(counts.items())), title), base_name)
     except Exception as e:
         st.warning(f"No se pudo mostrar/guardar el histograma: {e}")
 
-    return counts
-
 
 # =================== Cabecera didáctica ===================
 st.title("Superposición cuántica: demostrador interactivo")
@@ -138,16 +290,19 @@ st.markdown(
 
 # =================== Verificación de paquetes ===================
 with st.expander("Verificación rápida de paquetes"):
-    try:
-        import qiskit as _qiskit
-        import qiskit_aer as _qa
-        import qiskit_ibm_runtime as _qir
-        st.success("✅ Qiskit importado correctamente")
-        st.write(f"qiskit-aer versión: {_qa.__version__}")
-        st.write(f"qiskit-ibm-runtime versión: {_qir.__version__}")
-    except Exception as e:
-        st.error("⚠️ Problema importando paquetes. Asegúrate de instalar: 'pip install qiskit qiskit-aer'.")
-        st.exception(e)
+    # El contenido de un expander se ejecuta en cada rerun aunque esté cerrado:
+    # los imports pesados quedan detrás de un botón.
+    if st.button("Verificar paquetes", key="verificar"):
+        try:
+            import qiskit as _qiskit
+            import qiskit_aer as _qa
+            import qiskit_ibm_runtime as _qir
+            st.success("✅ Qiskit importado correctamente")
+            st.write(f"qiskit-aer versión: {_qa.__version__}")
+            st.write(f"qiskit-ibm-runtime versión: {_qir.__version__}")
+        except Exception as e:
+            st.error("⚠️ Problema importando paquetes. Asegúrate de instalar: 'pip install qiskit qiskit-aer'.")
+            st.exception(e)
 
 # =================== Pestañas por paso ===================
 tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs([
@@ -166,9 +321,8 @@ with tab1:
     shots = st.number_input("Shots", min_value=100, max_value=100000, step=100, value=DEFAULT_SHOTS)
 
     if st.button("Ejecutar Paso 1", key="p1"):
-        qc = QuantumCircuit(1)
-        qc.h(0)
-        qc.measure_all()
+        plt.close("all")  # red de seguridad ante figuras huérfanas
+        qc = paso1_circuit()
         run_and_plot_counts(qc, shots=shots, title="H |0⟩ → 50/50", base_name="p1_moneda")
 
 # ---- Paso 2 ----
@@ -181,10 +335,9 @@ with tab2:
     if st.button("Calcular expectativas", key="p2"):
         qc = QuantumCircuit(1)
         qc.h(0)
-        psi = Statevector.from_instruction(qc)
-        expZ = float(np.real(psi.expectation_value(Pauli("Z"))))
-        expX = float(np.real(psi.expectation_value(Pauli("X"))))
-        st.code(draw_circuit_text(qc), language="text")
+        qasm = qasm2.dumps(qc)
+        _, expZ, expX = _sv_probs_and_exps(qasm)
+        st.code(draw_circuit_text(qasm), language="text")
         st.metric("⟨Z⟩ (esperado ~0)", f"{expZ:.6f}")
         st.metric("⟨X⟩ (esperado ~+1)", f"{expX:.6f}")
 
@@ -195,10 +348,8 @@ with tab3:
     shots = st.number_input("Shots", min_value=100, max_value=100000, step=100, value=DEFAULT_SHOTS, key="shots3")
 
     if st.button("Ejecutar Paso 3", key="p3"):
-        qc = QuantumCircuit(1)
-        qc.h(0)
-        qc.h(0)
-        qc.measure_all()
+        plt.close("all")  # red de seguridad ante figuras huérfanas
+        qc = paso3_circuit()
         run_and_plot_counts(qc, shots=shots, title="H H |0⟩ → |0⟩", base_name="p3_hh")
 
 # ---- Paso 4 ----
@@ -208,11 +359,8 @@ with tab4:
     shots = st.number_input("Shots", min_value=100, max_value=100000, step=100, value=DEFAULT_SHOTS, key="shots4")
 
     if st.button("Ejecutar Paso 4", key="p4"):
-        qc = QuantumCircuit(1)
-        qc.h(0)
-        qc.p(math.pi, 0)
-        qc.h(0)
-        qc.measure_all()
+        plt.close("all")  # red de seguridad ante figuras huérfanas
+        qc = paso4_circuit()
         run_and_plot_counts(qc, shots=shots, title="H – P(π) – H → |1⟩", base_name="p4_fase_pi")
 
 # ---- Paso 5 ----
@@ -237,15 +385,26 @@ with tab5:
         shots = st.number_input("Shots", min_value=100, max_value=200000, step=100, value=20000)
 
     if st.button("Ejecutar Paso 5", key="p5"):
+        plt.close("all")  # red de seguridad ante figuras huérfanas
         qc = QuantumCircuit(1)
         qc.h(0)
         qc.rz(phi, 0)
         qc.h(0)
         qc.measure_all()
-        counts = run_and_plot_counts(qc, shots=shots, title=f"H – RZ({phi:.2f}) – H", base_name="p5_fase")
-        total = sum(counts.values()) or 1
-        p0 = counts.get('0', 0) / total
-        p1 = counts.get('1', 0) / total
+        title = f"H – RZ({phi:.2f}) – H"
+        if USE_AER:
+            counts = run_and_plot_counts(qc, shots=shots, title=title, base_name="p5_fase")
+            # El bit lógico es el último carácter de la clave (Aer puede separar registros con espacios)
+            k0 = sum(n for key, n in counts.items() if key.replace(" ", "")[-1] == "0")
+        else:
+            # Forma cerrada: P(0) = cos²(φ/2); una sola muestra binomial basta
+            p0_teo = math.cos(phi / 2) ** 2
+            k0 = int(st.session_state.rng.binomial(shots, p0_teo))
+            counts = {"0": k0, "1": shots - k0}
+            st.code(draw_circuit_text(qasm2.dumps(qc)), language="text")
+            plot_counts(counts, title=title, base_name="p5_fase")
+        p0 = k0 / shots
+        p1 = 1 - p0
         st.write(f"Proporciones observadas: **P(0)≈{100*p0:.2f}%** • **P(1)≈{100*p1:.2f}%** ")
         st.caption("Teórico: P(0)=cos²(φ/2), P(1)=sin²(φ/2)")
 
@@ -255,37 +414,30 @@ with tab6:
     st.write("Explora dos estados clave: `|+⟩` (tras aplicar H) y el estado tras **√X (sx)**.")
 
     if st.button("Mostrar Bloch de H y √X", key="p6"):
+        plt.close("all")  # red de seguridad ante figuras huérfanas
         # Estado A: |+> con H
         qc_h = QuantumCircuit(1)
         qc_h.h(0)
-        sv_h = Statevector.from_instruction(qc_h)
+        qasm_h = qasm2.dumps(qc_h)
+        sv_h_data, _, _ = _sv_probs_and_exps(qasm_h)
         st.markdown("**Circuito H:**")
-        st.code(draw_circuit_text(qc_h), language="text")
-        try:
-            fig_h = plot_bloch_multivector(sv_h)
-            st.pyplot(fig_h)
-            if SAVE_PNGS:
-                save_fig(fig_h, "p6_bloch_h")
-            else:
-                plt.close(fig_h)
-        except Exception as e:
-            st.warning(f"Bloch H: {e}")
+        st.code(draw_circuit_text(qasm_h), language="text")
 
         # Estado B: sobre ecuador con √X (sx)
         qc_sx = QuantumCircuit(1)
         qc_sx.sx(0)
-        sv_sx = Statevector.from_instruction(qc_sx)
+        qasm_sx = qasm2.dumps(qc_sx)
+        sv_sx_data, _, _ = _sv_probs_and_exps(qasm_sx)
         st.markdown("**Circuito √X (sx):**")
-        st.code(draw_circuit_text(qc_sx), language="text")
+        st.code(draw_circuit_text(qasm_sx), language="text")
+
+        # Ambos estados en una sola figura: producto tensorial (qubit 0 = H, qubit 1 = √X)
         try:
-            fig_sx = plot_bloch_multivector(sv_sx)
-            st.pyplot(fig_sx)
-            if SAVE_PNGS:
-                save_fig(fig_sx, "p6_bloch_sx")
-            else:
-                plt.close(fig_sx)
+            sv_combined = Statevector(sv_sx_data).tensor(Statevector(sv_h_data))
+            png = _bloch_png(tuple(sv_combined.data.round(10)), title="H  |  √X")
+            show_png(png, "p6_bloch_combined")
         except Exception as e:
-            st.warning(f"Bloch √X: {e}")
+            st.warning(f"Bloch H | √X: {e}")
 
 # =================== Cierre ===================
 st.divider()